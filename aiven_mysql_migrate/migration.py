@@ -13,7 +13,7 @@ from distutils.version import LooseVersion
 from pathlib import Path
 from pymysql.constants.ER import HANDSHAKE_ERROR
 from subprocess import Popen
-from typing import List, Optional
+from typing import Dict, FrozenSet, List, Optional
 
 import concurrent
 import enum
@@ -68,6 +68,7 @@ class MySQLMigration:
             self.ignore_dbs.update({db.strip() for db in filter_dbs.split(",")})
 
         self.skip_column_stats = False
+        self._databases_size: Dict[FrozenSet[str], int] = {}
 
         self.privilege_check_user = None
         if privilege_check_user:
@@ -88,10 +89,10 @@ class MySQLMigration:
 
     def list_databases(self) -> List[str]:
         with self.source.cur() as cur:
+            # pymysql expands a tuple parameter into a parenthesized list of escaped values
             cur.execute(
-                "SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA WHERE SCHEMA_NAME NOT IN ({format_dbs})".format(
-                    format_dbs=", ".join(["%s"] * len(self.ignore_dbs))
-                ), tuple(self.ignore_dbs)
+                "SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA WHERE SCHEMA_NAME NOT IN %s",
+                (tuple(self.ignore_dbs), )
             )
             return [row["SCHEMA_NAME"] for row in cur.fetchall()]
 
@@ -119,8 +120,9 @@ class MySQLMigration:
     def _check_server_id_overlapping(self):
         LOGGER.info("Checking for server id overlap")
 
-        with self.source.cur() as source_cur, self.target.cur() as target_cur:
+        with self.source.cur(cursor=pymysql.cursors.Cursor) as source_cur:
             source_server_id = select_global_var(source_cur, "server_id")
+        with self.target.cur(cursor=pymysql.cursors.Cursor) as target_cur:
             target_server_id = select_global_var(target_cur, "server_id")
 
         if source_server_id == target_server_id:
@@ -135,9 +137,7 @@ class MySQLMigration:
         with self.source.cur() as cur:
             cur.execute(
                 "SELECT COUNT(DISTINCT(ENGINE)) AS count FROM INFORMATION_SCHEMA.TABLES "
-                "WHERE TABLE_SCHEMA IN ({format_dbs}) AND ENGINE IS NOT NULL AND UPPER(ENGINE) != 'INNODB'".format(
-                    format_dbs=",".join(["%s"] * len(self.databases))
-                ), tuple(self.databases)
+                "WHERE TABLE_SCHEMA IN %s AND ENGINE IS NOT NULL AND UPPER(ENGINE) != 'INNODB'", (tuple(self.databases), )
             )
             res = cur.fetchone()
             if not res["count"] == 0:
@@ -146,7 +146,7 @@ class MySQLMigration:
     def _check_gtid_mode_enabled(self):
         for conn_info in (self.source, self.target):
             LOGGER.info("Checking if GTID mode is enabled on the %s", conn_info.name)
-            with conn_info.cur() as cur:
+            with conn_info.cur(cursor=pymysql.cursors.Cursor) as cur:
                 gtid_mode = select_global_var(cur, "gtid_mode")
                 if gtid_mode.upper() != "ON":
                     raise GTIDModeDisabledException(f"GTID mode should be enabled on the {conn_info.name}")
@@ -185,21 +185,33 @@ class MySQLMigration:
                 f"Too many databases to migrate: {len(self.databases)} (> {config.MYSQL_MAX_DATABASES})"
             )
 
+    def _get_databases_size(self) -> int:
+        """Total size of the databases to migrate. Cached per set of ignored databases as INFORMATION_SCHEMA queries
+        are slow on servers with many tables. Ignored databases are filtered in SQL, like in `list_databases`, so that
+        names are matched with the server's collation."""
+        ignore_dbs = frozenset(self.ignore_dbs)
+        if ignore_dbs not in self._databases_size:
+            # Read before opening the cursor, an uncached version is fetched over a connection of its own
+            version = self.source.version
+            with self.source.cur() as cur:
+                if LooseVersion(version) >= LooseVersion("8.0.0"):
+                    # MySQL 8 caches table statistics, make sure we get up to date sizes
+                    cur.execute("SET SESSION information_schema_stats_expiry = 0")
+                cur.execute(
+                    "SELECT SUM(DATA_LENGTH + INDEX_LENGTH) AS size FROM INFORMATION_SCHEMA.TABLES "
+                    "WHERE TABLE_SCHEMA NOT IN %s", (tuple(ignore_dbs), )
+                )
+                self._databases_size[ignore_dbs] = int(cur.fetchone()["size"] or 0)
+        return self._databases_size[ignore_dbs]
+
     def _check_database_size(self, max_size: float):
         LOGGER.info("Checking max total databases size")
 
-        with self.source.cur() as cur:
-            cur.execute(
-                "SELECT SUM(DATA_LENGTH + INDEX_LENGTH) AS size FROM INFORMATION_SCHEMA.TABLES "
-                "WHERE TABLE_SCHEMA NOT IN ({format_dbs})".format(format_dbs=", ".join(["%s"] * len(self.ignore_dbs))),
-                tuple(self.ignore_dbs)
-            )
-            source_size = cur.fetchone()["size"] or 0
-        if source_size > max_size:
+        if self._get_databases_size() > max_size:
             raise DatabaseTooLargeException()
 
     def _check_bin_log_format(self):
-        with self.source.cur() as cur:
+        with self.source.cur(cursor=pymysql.cursors.Cursor) as cur:
             row_format = select_global_var(cur, "binlog_format")
             if row_format.upper() != "ROW":
                 raise UnsupportedBinLogFormatException(f"Unsupported binary log format: {row_format}, only ROW is supported")
@@ -321,12 +333,12 @@ class MySQLMigration:
             self._get_dump_command(migration_method=migration_method),
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            universal_newlines=True
         )
+        # Dump lines are passed from mysqldump to mysql as bytes, decoding and encoding every line is not needed
         self.mysql_proc = Popen(  # pylint: disable=consider-using-with
             self._get_import_command(),
             stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE, text=True
+            stderr=subprocess.PIPE,
         )
 
         # Disallow creating child processes in migration target when this runs as non-root user.
@@ -338,26 +350,23 @@ class MySQLMigration:
         assert self.mysql_proc.stdin
 
         # If sql_require_primary_key is ON globally - it's not possible to import tables without a primary key
-        with self.target.cur() as cur:
+        with self.target.cur(cursor=pymysql.cursors.Cursor) as cur:
             if select_global_var(cur, "sql_require_primary_key") == 1:
-                self.mysql_proc.stdin.write("SET SESSION sql_require_primary_key = 0;")
+                self.mysql_proc.stdin.write(b"SET SESSION sql_require_primary_key = 0;")
 
         def _reader_stdout():
-            for line in self.mysqldump_proc.stdout:
-                line = dump_processor.process_line(line.rstrip())
-
-                if not line:
-                    continue
-
-                LOGGER.debug("dump: %s", line)
-                self.mysql_proc.stdin.write(line + "\n")
+            debug = LOGGER.isEnabledFor(logging.DEBUG)
+            for line in dump_processor.process_lines(self.mysqldump_proc.stdout):
+                if debug:
+                    LOGGER.debug("dump: %s", line[:-1].decode(errors="replace"))
+                self.mysql_proc.stdin.write(line)
 
             self.mysql_proc.stdin.flush()
             self.mysql_proc.stdin.close()
 
         def _reader_stderr(proc):
             for line in proc.stderr:
-                sys.stderr.write(line)
+                sys.stderr.write(line.decode(errors="replace"))
 
         with futures.ThreadPoolExecutor(max_workers=3) as executor:
             for future in concurrent.futures.as_completed([
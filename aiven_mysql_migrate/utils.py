@@ -1,32 +1,70 @@
 # Copyright (c) 2020 Aiven, Helsinki, Finland. https://aiven.io/
 from aiven_mysql_migrate import config
 from aiven_mysql_migrate.exceptions import WrongMigrationConfigurationException
-from dataclasses import dataclass
-from typing import AnyStr, Dict, List, Optional
-from urllib.parse import parse_qs, quote, unquote, urlparse
+from dataclasses import dataclass, field
+from typing import AnyStr, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote, unquote, unquote_plus, urlsplit
 
 import contextlib
+import functools
 import pymysql
 import re
+import sys
 
 DEFAULT_MYSQL_PORT = 3306
-ALLOWED_OPTIONS = {"ssl-mode"}
+ALLOWED_OPTIONS = frozenset({"ssl-mode"})
+# "DISABLE" is a previously documented legacy value
+DISABLED_SSL_MODES = frozenset({"DISABLE", "DISABLED"})
+SSL_MODES = DISABLED_SSL_MODES | {"REQUIRED"}
 # See https://dev.mysql.com/doc/mysql-errors/8.0/en/server-error-reference.html#error_er_change_master_password_length
 MAX_PASSWORD_LENGTH = 32
 
-ROUTINE_DEFINER_RE = re.compile("^CREATE DEFINER *= *(`.*?`@`.*?`) +(.*$)")
-IMPORT_DEFINER_RE = re.compile(r"^/\*!50013 DEFINER *= *`.*?`@`.*?` +SQL SECURITY DEFINER \*/$")
-EXTRA_DEFINER_RE = re.compile(r"^(/\*!(?:50003|50106) CREATE *\*/ *)(/\*!(?:50017|50117) +DEFINER *= *`.*?`@`.*?`\*/)(.*$)")
+# URIs as produced by `MySQLConnectionInfo.to_uri` for plain host names, these can be parsed without `urlsplit`.
+# Used with `fullmatch`. User name and password are limited to printable ASCII: `urlsplit` removes tabs and newlines
+# from URIs and rejects non-ASCII characters which normalize to URI delimiters, such URIs take the generic path.
+CANONICAL_URI_CREDENTIAL = r"([^\x00-\x20\x7f-\U0010ffff:@/?#\[\]]+)"
+CANONICAL_URI_RE = re.compile(
+    rf"mysql://{CANONICAL_URI_CREDENTIAL}:{CANONICAL_URI_CREDENTIAL}@([A-Za-z0-9.-]+):([0-9]{{1,5}})/"
+    r"(?:\?ssl-mode=(REQUIRED|DISABLED))?"
+)
+
+# Dump processing works on raw bytes, dump lines are not decoded on their way from mysqldump to mysql.
+# DEFINER clauses are removed by scanning for these fixed parts instead of with regular expressions.
+ROUTINE_DEFINER_PREFIX = b"CREATE DEFINER"
+IMPORT_DEFINER_PREFIX = b"/*!50013 DEFINER"
+IMPORT_DEFINER_SUFFIX = b" SQL SECURITY DEFINER */"
+EXTRA_DEFINER_CREATE_PREFIXES = (b"/*!50003 CREATE", b"/*!50106 CREATE")
+EXTRA_DEFINER_PREFIXES = (b"/*!50017 ", b"/*!50117 ")
+
+GTID_START_RE = re.compile(rb"^SET +@@GLOBAL.GTID_PURGED *= */\*!80000 +'\+'\*/ *'([^']*)")
+GTID_END_RE = re.compile(rb"^(.*?)' *;")
+
+# Used with `fullmatch`: the greedy value backtracks only to the final ";" instead of trying every ";" of the line
+LOG_BIN_RE = re.compile(rb"SET +@@SESSION.SQL_LOG_BIN *= *.*;")
+
+# Lines not starting with one of these can't contain a DEFINER clause which needs to be removed
+DEFINER_LINE_PREFIXES = (ROUTINE_DEFINER_PREFIX, IMPORT_DEFINER_PREFIX) + EXTRA_DEFINER_CREATE_PREFIXES
+# Lines not starting with one of these are never changed by `MySQLDumpProcessor.process_line`, unless they continue a
+# multi-line GTID statement
+PROCESSED_LINE_PREFIXES = (b"SET ", ) + DEFINER_LINE_PREFIXES
+# Characters removed by `bytes.rstrip()`
+WHITESPACE = b" \t\n\r\x0b\x0c"
+
+# `slots` is only supported by dataclasses since Python 3.10, older versions keep using per-instance `__dict__`
+DATACLASS_SLOTS: Dict[str, bool] = {"slots": True} if sys.version_info >= (3, 10) else {}
 
-GTID_START_RE = re.compile(r"^SET +@@GLOBAL.GTID_PURGED *= */\*!80000 +'\+'\*/ *'([^']*)")
-GTID_END_RE = re.compile(r"^(.*?)' *;")
+GLOBAL_GRANTS_RE = re.compile("^GRANT +(.*) +ON +\\*\\.\\* +TO.*$")
 
-LOG_BIN_RE = re.compile(r"^SET +@@SESSION.SQL_LOG_BIN *= *.*?;$")
+# Global variables which are allowed to be read with `select_global_var`, queries are built once so that the same
+# statement text is sent to the server on every call
+ALLOWED_GLOBAL_VARS = frozenset({"binlog_format", "gtid_mode", "server_id", "sql_require_primary_key", "version"})
+GLOBAL_VAR_QUERIES = {var_name: f"SELECT @@GLOBAL.{var_name}" for var_name in ALLOWED_GLOBAL_VARS}
 
-GLOBAL_GRANTS_RE = re.compile("^GRANT +(.*) +ON +\\*\\.\\* +TO.*$")
+# Fields of `MySQLConnectionInfo` which are part of its URI
+URIKey = Tuple[str, int, str, str, Optional[bool]]
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class MySQLConnectionInfo:
     hostname: str
     port: int
@@ -38,11 +76,43 @@ class MySQLConnectionInfo:
 
     _version: Optional[str] = None
     _global_grants: Optional[List[str]] = None
+    # Cache of `to_uri`, not part of the connection info itself
+    _uri: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    _uri_key: Optional[URIKey] = field(default=None, init=False, repr=False, compare=False)
 
     @staticmethod
     def from_uri(uri: str, name: Optional[str] = None):
+        hostname, port, username, password, ssl = MySQLConnectionInfo._parse_uri(uri)
+        return MySQLConnectionInfo(
+            hostname=hostname,
+            port=port,
+            username=username,
+            password=password,
+            ssl=ssl,
+            name=name,
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _parse_uri(uri: str) -> Tuple[str, int, str, str, bool]:
+        """Parse and validate the service URI. Only the parsed values are cached, every `from_uri` call creates a new
+        instance as connection info objects are mutable."""
+        canonical_match = CANONICAL_URI_RE.fullmatch(uri)
+        if canonical_match:
+            username, password, hostname, port, ssl_mode = canonical_match.groups()
+            # Port 0 and out of range ports are handled (or rejected) by the generic path
+            if 0 < int(port) <= 65535:
+                password = unquote(password)
+                MySQLConnectionInfo._validate_password(password)
+                return hostname.lower(), int(port), unquote(username), password, ssl_mode != "DISABLED"
+
+        return MySQLConnectionInfo._parse_generic_uri(uri)
+
+    @staticmethod
+    def _parse_generic_uri(uri: str) -> Tuple[str, int, str, str, bool]:
         try:
-            res = urlparse(uri, scheme="mysql")
+            # `urlsplit` is enough, path parameters (";") are not used by service URIs
+            res = urlsplit(uri, scheme="mysql")
             if res.scheme != "mysql" or not res.username or not res.password or not res.hostname:
                 raise WrongMigrationConfigurationException(f"{uri!r} is not a valid service URI")
 
@@ -55,36 +125,51 @@ class MySQLConnectionInfo:
             raise WrongMigrationConfigurationException(f"{uri!r} invalid port") from e
 
         password = unquote(res.password)
-        if len(password.encode()) > MAX_PASSWORD_LENGTH:
-            raise WrongMigrationConfigurationException("The password for the replication user must not exceed 32 characters")
+        MySQLConnectionInfo._validate_password(password)
 
-        options = parse_qs(res.query)
+        options = MySQLConnectionInfo._parse_options(res.query) if res.query else {}
         MySQLConnectionInfo._validate_options(options)
 
-        ssl = not (options and options.get("ssl-mode", ["DISABLED"]) in (["DISABLE"], ["DISABLED"]))
-        return MySQLConnectionInfo(
-            hostname=res.hostname,
-            port=port,
-            username=unquote(res.username),
-            password=password,
-            ssl=ssl,
-            name=name,
-        )
+        ssl = "ssl-mode" not in options or options["ssl-mode"][0] not in DISABLED_SSL_MODES
+        return res.hostname, port, unquote(res.username), password, ssl
+
+    @staticmethod
+    def _parse_options(query: str) -> Dict[str, List[str]]:
+        """Equivalent of `parse_qs` for the few options of a service URI, without its generic parsing machinery:
+        options without a value are dropped and repeated options collect all of their values"""
+        options: Dict[str, List[str]] = {}
+        for option in query.split("&"):
+            key, separator, value = option.partition("=")
+            if separator and value:
+                options.setdefault(unquote_plus(key), []).append(unquote_plus(value))
+        return options
+
+    @staticmethod
+    def _validate_password(password: str) -> None:
+        if len(password.encode()) > MAX_PASSWORD_LENGTH:
+            raise WrongMigrationConfigurationException("The password for the replication user must not exceed 32 characters")
 
     @staticmethod
     def _validate_options(options: Dict[str, List[AnyStr]]) -> None:
         if not ALLOWED_OPTIONS.issuperset(options):
             raise WrongMigrationConfigurationException(f"Only {', '.join(ALLOWED_OPTIONS)} allowed as uri parameter")
 
-        if options and "ssl-mode" in options:
+        if "ssl-mode" in options:
             ssl_mode = options["ssl-mode"]
-            if ssl_mode not in (["DISABLE"], ["DISABLED"], ["REQUIRED"]):
+            # passing the option multiple times is not allowed either
+            if len(ssl_mode) != 1 or ssl_mode[0] not in SSL_MODES:
                 # don't include the legacy value in the error message
                 raise WrongMigrationConfigurationException("ssl-mode must be either 'DISABLED' or 'REQUIRED'")
 
     def to_uri(self):
-        ssl_mode = "DISABLED" if not self.ssl else "REQUIRED"
-        return f"mysql://{quote(self.username)}:{quote(self.password)}@{self.hostname}:{self.port}/?ssl-mode={ssl_mode}"
+        # Fields can be changed after construction (e.g. `ssl`), so the cached URI is rebuilt whenever they differ
+        uri_key = (self.hostname, self.port, self.username, self.password, self.ssl)
+        if self._uri is None or self._uri_key != uri_key:
+            ssl_mode = "DISABLED" if not self.ssl else "REQUIRED"
+            credentials = f"{quote(self.username)}:{quote(self.password)}"
+            self._uri = f"mysql://{credentials}@{self.hostname}:{self.port}/?ssl-mode={ssl_mode}"
+            self._uri_key = uri_key
+        return self._uri
 
     def repr(self):
         return self.name
@@ -109,7 +194,7 @@ class MySQLConnectionInfo:
     @property
     def version(self) -> str:
         if self._version is None:
-            with self.cur() as source_cur:
+            with self.cur(cursor=pymysql.cursors.Cursor) as source_cur:
                 self._version = select_global_var(source_cur, "version")
         return self._version
 
@@ -142,7 +227,7 @@ class MySQLConnectionInfo:
             yield ctx.cursor(**kwargs)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **DATACLASS_SLOTS)
 class PrivilegeCheckUser:
     username: str
     host: Optional[str] = None
@@ -172,42 +257,110 @@ class PrivilegeCheckUser:
         return params
 
 
-class MySQLDumpProcessor:
-    def __init__(self):
-        self.gtid = None
-        self.gtid_block = ""
+def _remove_log_bin_data(line: bytes) -> bytes:
+    """Remove setting of SQL_LOG_BIN, target might have replicas running, which need to get this data replicated"""
+    if line and LOG_BIN_RE.fullmatch(line):
+        return b""
+
+    return line
+
+
+def _skip_spaces(line: bytes, pos: int) -> int:
+    while line.startswith(b" ", pos):
+        pos += 1
+    return pos
+
+
+def _find_definer_host(line: bytes, pos: int) -> int:
+    """Scan `` = `user`@` `` following a DEFINER keyword ending at `pos`, return the start of the host name or -1"""
+    pos = _skip_spaces(line, pos)
+    if not line.startswith(b"=", pos):
+        return -1
+    pos = _skip_spaces(line, pos + 1)
+    if not line.startswith(b"`", pos):
+        return -1
+    user_end = line.find(b"`@`", pos + 1)
+    return -1 if user_end == -1 else user_end + 3
+
+
+def _remove_routine_definer(line: bytes) -> bytes:
+    # CREATE DEFINER=`user`@`host` PROCEDURE ...
+    host_start = _find_definer_host(line, len(ROUTINE_DEFINER_PREFIX))
+    if host_start != -1:
+        host_end = line.find(b"` ", host_start)
+        if host_end != -1:
+            return b"CREATE " + line[host_end + 2:].lstrip(b" ")
+    return line
+
+
+def _remove_import_definer(line: bytes) -> bytes:
+    # /*!50013 DEFINER=`user`@`host` SQL SECURITY DEFINER */
+    if line.endswith(IMPORT_DEFINER_SUFFIX):
+        host_start = _find_definer_host(line, len(IMPORT_DEFINER_PREFIX))
+        if host_start != -1 and line[host_start:-len(IMPORT_DEFINER_SUFFIX)].rstrip(b" ").endswith(b"`"):
+            return b""
+    return line
+
+
+def _remove_extra_definer(line: bytes) -> bytes:
+    # /*!50003 CREATE*/ /*!50017 DEFINER=`user`@`host`*/ /*!50003 TRIGGER ...
+    pos = _skip_spaces(line, len(EXTRA_DEFINER_CREATE_PREFIXES[0]))
+    if not line.startswith(b"*/", pos):
+        return line
+    definer_start = _skip_spaces(line, pos + 2)
+    if not line.startswith(EXTRA_DEFINER_PREFIXES, definer_start):
+        return line
+    pos = _skip_spaces(line, definer_start + len(EXTRA_DEFINER_PREFIXES[0]))
+    if not line.startswith(b"DEFINER", pos):
+        return line
+    host_start = _find_definer_host(line, pos + len(b"DEFINER"))
+    if host_start != -1:
+        definer_end = line.find(b"`*/", host_start)
+        if definer_end != -1:
+            return line[:definer_start] + line[definer_end + 3:]
+    return line
 
-    @staticmethod
-    def _remove_log_bin_data(line: str) -> str:
-        """Remove setting of SQL_LOG_BIN, target might have replicas running, which need to get this data replicated"""
-        if line and LOG_BIN_RE.match(line):
-            return ""
 
+def _remove_definers(line: bytes) -> bytes:
+    """Remove security definers from routines and dump meta, so that the default definer is used"""
+    if b"DEFINER" not in line:
         return line
 
-    @staticmethod
-    def _remove_definers(line: str) -> str:
-        """Remove security definers from routines and dump meta, so that the default definer is used"""
-        if IMPORT_DEFINER_RE.match(line):
-            return ""
-
-        if EXTRA_DEFINER_RE.match(line):
-            return EXTRA_DEFINER_RE.sub("\\1\\3", line)
-
-        return ROUTINE_DEFINER_RE.sub("CREATE \\2", line)
-
-    def process_line(self, line: str) -> str:
-        if line and not self.gtid:
-            if self.gtid_block:
-                # Continuation of previous line
-                end_match = GTID_END_RE.match(line)
-                if end_match:
-                    self.gtid_block = self.gtid_block + end_match.group(1)
-                    self.gtid = self.gtid_block
-                else:
-                    self.gtid_block = self.gtid_block + line
-                return ""
+    # The line prefix selects the kind of DEFINER clause, which is then located with a single forward scan
+    if line.startswith(ROUTINE_DEFINER_PREFIX):
+        return _remove_routine_definer(line)
+    if line.startswith(IMPORT_DEFINER_PREFIX):
+        return _remove_import_definer(line)
+    if line.startswith(EXTRA_DEFINER_CREATE_PREFIXES):
+        return _remove_extra_definer(line)
+
+    return line
+
+
+class MySQLDumpProcessor:
+    __slots__ = ("gtid", "gtid_parts")
+
+    def __init__(self):
+        self.gtid: Optional[bytes] = None
+        # Parts of a GTID set spanning multiple lines, collected until the closing quote. None outside of such a
+        # statement, the parts are joined once instead of concatenating bytes for every line.
+        self.gtid_parts: Optional[List[bytes]] = None
+
+    def process_line(self, line: bytes) -> bytes:
+        if self.gtid_parts is not None:
+            # Continuation of previous line
+            end_match = GTID_END_RE.match(line)
+            if end_match:
+                self.gtid_parts.append(end_match.group(1))
+                self.gtid = b"".join(self.gtid_parts)
+                self.gtid_parts = None
             else:
+                self.gtid_parts.append(line)
+            return b""
+
+        # Lines are dispatched on their prefix, most dump lines (e.g. INSERTs) don't need any further processing.
+        if line.startswith(b"SET "):
+            if not self.gtid:
                 # Search for the start
                 start_match = GTID_START_RE.match(line)
                 if start_match:
@@ -216,18 +369,47 @@ class MySQLDumpProcessor:
                         self.gtid = start_match.group(1)
                     else:
                         # Multi-line GTID comment
-                        self.gtid_block = start_match.group(1)
-                    return ""
+                        self.gtid_parts = [start_match.group(1)]
+                    return b""
+
+            return _remove_log_bin_data(line)
 
-        line = MySQLDumpProcessor._remove_log_bin_data(line)
-        line = MySQLDumpProcessor._remove_definers(line)
+        if line.startswith(DEFINER_LINE_PREFIXES):
+            return _remove_definers(line)
 
         return line
 
-    def get_gtid(self):
-        return self.gtid
+    def process_lines(self, lines: Iterable[bytes]) -> Iterator[bytes]:
+        """Process a stream of dump lines, yielding the lines to import with a trailing newline. Trailing whitespace is
+        stripped and lines which end up empty are dropped. Most lines don't need any processing: when such a line
+        ends with a single newline it is yielded as it is, without being copied."""
+        process_line = self.process_line
+        for line in lines:
+            # Indexing bytes gives an int, which is looked up in WHITESPACE without creating a slice
+            if (
+                self.gtid_parts is None and len(line) > 1 and line.endswith(b"\n") and line[-2] not in WHITESPACE
+                and not line.startswith(PROCESSED_LINE_PREFIXES)
+            ):
+                yield line
+                continue
+
+            line = line.rstrip()
+            if self.gtid_parts is not None or line.startswith(PROCESSED_LINE_PREFIXES):
+                line = process_line(line)
+            if line:
+                yield line + b"\n"
+
+    def get_gtid(self) -> Optional[str]:
+        return self.gtid.decode() if self.gtid is not None else None
 
 
 def select_global_var(cur, var_name: str):
-    cur.execute(f"SELECT @@GLOBAL.{var_name} AS VAR")
-    return cur.fetchone()["VAR"]
+    """Read a single global variable. Works with any cursor, tuple cursors (``pymysql.cursors.Cursor``) avoid building
+    a dict for the single column."""
+    try:
+        query = GLOBAL_VAR_QUERIES[var_name]
+    except KeyError as e:
+        raise ValueError(f"Reading global variable {var_name!r} is not allowed") from e
+    cur.execute(query)
+    row = cur.fetchone()
+    return next(iter(row.values())) if isinstance(row, dict) else row[0]
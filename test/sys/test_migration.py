@@ -4,21 +4,44 @@ from aiven_mysql_migrate.exceptions import (
 )
 from aiven_mysql_migrate.migration import MySQLMigrateMethod, MySQLMigration
 from aiven_mysql_migrate.utils import MySQLConnectionInfo
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import nullcontext as does_not_raise
 from pathlib import Path
 from pytest import fixture, mark
+from typing import Any, Dict, Tuple
 
+import dataclasses
 import json
 import logging
 import pytest
-import random
-import string
+import secrets
 import time
 
 MYSQL_WAIT_RETRIES = 30
 MYSQL_WAIT_SLEEP = 2
+MYSQL_WAIT_MIN_SLEEP = 0.05
+# Must be lower than the read timeout of the connection (config.MYSQL_READ_TIMEOUT)
+REPLICATION_WAIT_TIMEOUT = 4
 LOGGER = logging.getLogger(__name__)
 
+# Host name -> whether SSL is used to connect
+MYSQL_HOSTS = {
+    "mysql57-src-1": True,
+    "mysql80-src-2": True,
+    "mysql80-src-3": True,
+    "mysql80-src-4": False,
+    "mysql80-dst-1": True,
+    "mysql80-dst-2": True,
+    "mysql80-dst-3": True,
+}
+# Source and target hosts used together in tests, a source host must not be used with multiple target hosts
+MYSQL_PAIRS = {
+    "57-80-1": ("mysql57-src-1", "mysql80-dst-1"),
+    "80-80-2": ("mysql80-src-2", "mysql80-dst-2"),
+    "80-80-3": ("mysql80-src-3", "mysql80-dst-3"),
+    "80-nossl-80-3": ("mysql80-src-4", "mysql80-dst-3"),
+}
+
 
 class TimeoutException(Exception):
     pass
@@ -26,32 +49,69 @@ class TimeoutException(Exception):
 
 @fixture(name="db_name")
 def random_db_name():
-    return "".join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
+    # Prefixed so that the name can't be parsed as a number (e.g. "1e10...")
+    return "t_" + secrets.token_hex(5)
 
 
-def my_wait(host, ssl=True, retries=MYSQL_WAIT_RETRIES) -> MySQLConnectionInfo:
+def my_wait(host, ssl=True, timeout=MYSQL_WAIT_RETRIES * MYSQL_WAIT_SLEEP) -> MySQLConnectionInfo:
     uri = f"mysql://root:test@{host}/"
     if not ssl:
         uri += "?ssl-mode=DISABLED"
     conn = MySQLConnectionInfo.from_uri(uri)
-    for _ in range(retries):
+    deadline = time.monotonic() + timeout
+    # Exponential backoff, so that hosts which are almost ready are not waited for a full MYSQL_WAIT_SLEEP
+    sleep = MYSQL_WAIT_MIN_SLEEP
+    while True:
         try:
             with conn.cur() as cur:
                 cur.execute("SELECT VERSION()")
                 return conn
         except Exception as ex:  # pylint: disable=broad-except
             LOGGER.warning("%s is not yet ready: %s", host, ex)
-            time.sleep(MYSQL_WAIT_SLEEP)
+            if time.monotonic() + sleep > deadline:
+                break
+            time.sleep(sleep)
+            sleep = min(sleep * 2, MYSQL_WAIT_SLEEP)
     raise TimeoutException(f"Timeout while waiting for {host}")
 
 
-@mark.parametrize(
-    "src,dst", [
-        (my_wait("mysql57-src-1"), my_wait("mysql80-dst-1")),
-        (my_wait("mysql80-src-2"), my_wait("mysql80-dst-2")),
-    ]
-)
-def test_migration_replication(src: MySQLConnectionInfo, dst: MySQLConnectionInfo, db_name: str, tmp_path: Path) -> None:
+# Hosts are waited for in the background, starting when the first test using them is set up. Each pytest-xdist worker
+# only connects to the hosts of its own tests.
+_executor = ThreadPoolExecutor(max_workers=len(MYSQL_HOSTS))
+HOST_FUTURES: Dict[str, "Future[MySQLConnectionInfo]"] = {}
+
+
+def wait_for_host(host: str) -> "Future[MySQLConnectionInfo]":
+    if host not in HOST_FUTURES:
+        HOST_FUTURES[host] = _executor.submit(my_wait, host, ssl=MYSQL_HOSTS[host])
+    return HOST_FUTURES[host]
+
+
+def pair_param(pair: str, *values: Any) -> Any:
+    """Parametrize values for the `mysql_pair` fixture. Tests using the same hosts are put into the same pytest-xdist
+    group: they would otherwise interfere, e.g. by creating databases while sizes are checked. Groups are named after
+    the destination host, each source host is only paired with a single destination host."""
+    return pytest.param(pair, *values, marks=mark.xdist_group(name=MYSQL_PAIRS[pair][1]))
+
+
+@fixture(name="mysql_pair", scope="session")
+def fixture_mysql_pair(request) -> Tuple[MySQLConnectionInfo, MySQLConnectionInfo]:
+    """Source and target connection infos for a key of MYSQL_PAIRS, shared by all tests of the session"""
+    src_future, dst_future = (wait_for_host(host) for host in MYSQL_PAIRS[request.param])
+    return src_future.result(), dst_future.result()
+
+
+def make_migration(src: MySQLConnectionInfo, dst: MySQLConnectionInfo, **kwargs) -> MySQLMigration:
+    """Migration from src to dst, using dst for managing replication as well"""
+    dst_uri = dst.to_uri()
+    return MySQLMigration(source_uri=src.to_uri(), target_uri=dst_uri, target_master_uri=dst_uri, **kwargs)
+
+
+@mark.parametrize("mysql_pair", [pair_param("57-80-1"), pair_param("80-80-2")], indirect=True)
+def test_migration_replication(
+    mysql_pair: Tuple[MySQLConnectionInfo, MySQLConnectionInfo], db_name: str, tmp_path: Path
+) -> None:
+    src, dst = mysql_pair
     output_meta_file = tmp_path / "meta.json"
     with src.cur() as cur:
         cur.execute(f"CREATE DATABASE {db_name}")
@@ -62,13 +122,7 @@ def test_migration_replication(src: MySQLConnectionInfo, dst: MySQLConnectionInf
         cur.execute("SELECT @@GLOBAL.SERVER_UUID AS UUID")
         server_uuid = cur.fetchone()["UUID"]
 
-    migration = MySQLMigration(
-        source_uri=src.to_uri(),
-        target_uri=dst.to_uri(),
-        target_master_uri=dst.to_uri(),
-        privilege_check_user="root@%",
-        output_meta_file=output_meta_file,
-    )
+    migration = make_migration(src, dst, privilege_check_user="root@%", output_meta_file=output_meta_file)
     method = migration.run_checks()
     assert method == MySQLMigrateMethod.replication
     migration.start(migration_method=method, seconds_behind_master=0)
@@ -87,22 +141,23 @@ def test_migration_replication(src: MySQLConnectionInfo, dst: MySQLConnectionInf
     with src.cur() as cur:
         cur.execute(f"INSERT INTO {db_name}.test (ID) VALUES (%s)", ["repl_data"])
         cur.execute("COMMIT")
+        cur.execute("SELECT @@GLOBAL.GTID_EXECUTED AS GTIDS")
+        src_gtids = cur.fetchone()["GTIDS"]
 
-    for _ in range(5):
-        with dst.cur() as cur:
-            cur.execute(f"SELECT ID FROM {db_name}.test")
-            res = cur.fetchall()
-            if len(res) == 2 and sorted(["test_data", "repl_data"]) == sorted([item["ID"] for item in res]):
-                return
-        time.sleep(1)
+    with dst.cur() as cur:
+        # Blocks until the replica has applied all source transactions, instead of polling for the data
+        cur.execute("SELECT WAIT_FOR_EXECUTED_GTID_SET(%s, %s) AS TIMED_OUT", [src_gtids, REPLICATION_WAIT_TIMEOUT])
+        if cur.fetchone()["TIMED_OUT"]:
+            raise TimeoutException()
 
-    raise TimeoutException()
+        cur.execute(f"SELECT ID FROM {db_name}.test")
+        res = cur.fetchall()
+        assert len(res) == 2 and {"test_data", "repl_data"} == {item["ID"] for item in res}
 
 
-@mark.parametrize("src,dst", [
-    (my_wait("mysql80-src-3"), my_wait("mysql80-dst-3")),
-])
-def test_migration_fallback(src: MySQLConnectionInfo, dst: MySQLConnectionInfo, db_name: str) -> None:
+@mark.parametrize("mysql_pair", [pair_param("80-80-3")], indirect=True)
+def test_migration_fallback(mysql_pair: Tuple[MySQLConnectionInfo, MySQLConnectionInfo], db_name: str) -> None:
+    src, dst = mysql_pair
     with src.cur() as cur:
         cur.execute(f"CREATE DATABASE {db_name}")
         cur.execute(f"USE {db_name}")
@@ -111,11 +166,7 @@ def test_migration_fallback(src: MySQLConnectionInfo, dst: MySQLConnectionInfo,
         cur.execute("CREATE PROCEDURE test_proc (OUT body TEXT) BEGIN SELECT 'test_body'; END")
         cur.execute("COMMIT")
 
-    migration = MySQLMigration(
-        source_uri=src.to_uri(),
-        target_uri=dst.to_uri(),
-        target_master_uri=dst.to_uri(),
-    )
+    migration = make_migration(src, dst)
     method = migration.run_checks()
     assert method == MySQLMigrateMethod.dump
     migration.start(migration_method=method, seconds_behind_master=0)
@@ -131,16 +182,15 @@ def test_migration_fallback(src: MySQLConnectionInfo, dst: MySQLConnectionInfo,
 
 
 @mark.parametrize(
-    "src,dst,forced_method,context", [
-        (my_wait("mysql80-src-2"), my_wait("mysql80-dst-2"), MySQLMigrateMethod.replication, does_not_raise()),
-        (
-            my_wait("mysql80-src-3"), my_wait("mysql80-dst-3"), MySQLMigrateMethod.replication,
-            pytest.raises(ReplicationNotAvailableException)
-        ),
-        (my_wait("mysql80-src-3"), my_wait("mysql80-dst-3"), MySQLMigrateMethod.dump, does_not_raise()),
-    ]
+    "mysql_pair,forced_method,context", [
+        pair_param("80-80-2", MySQLMigrateMethod.replication, does_not_raise()),
+        pair_param("80-80-3", MySQLMigrateMethod.replication, pytest.raises(ReplicationNotAvailableException)),
+        pair_param("80-80-3", MySQLMigrateMethod.dump, does_not_raise()),
+    ],
+    indirect=["mysql_pair"]
 )
-def test_force_migration_method(src, dst, forced_method, context, db_name):
+def test_force_migration_method(mysql_pair, forced_method, context, db_name):
+    src, dst = mysql_pair
     with src.cur() as cur:
         cur.execute(f"CREATE DATABASE {db_name}")
         cur.execute(f"USE {db_name}")
@@ -148,44 +198,28 @@ def test_force_migration_method(src, dst, forced_method, context, db_name):
         cur.execute("INSERT INTO test (ID) VALUES (%s)", ["test_data"])
         cur.execute("COMMIT")
 
-    migration = MySQLMigration(
-        source_uri=src.to_uri(),
-        target_uri=dst.to_uri(),
-        target_master_uri=dst.to_uri(),
-        privilege_check_user="root@%",
-    )
+    migration = make_migration(src, dst, privilege_check_user="root@%")
 
     with context:
         method = migration.run_checks(force_method=forced_method)
         assert method == forced_method
 
 
-@mark.parametrize("src,dst", [
-    (my_wait("mysql80-src-3"), my_wait("mysql80-dst-3")),
-])
-def test_database_size_check(src, dst, db_name):
-    ignore_dbs = IGNORE_SYSTEM_DATABASES.copy()
-    ignore_dbs.add(db_name)
+@mark.parametrize("mysql_pair", [pair_param("80-80-3")], indirect=True)
+def test_database_size_check(mysql_pair, db_name):
+    src, dst = mysql_pair
+    ignore_dbs = IGNORE_SYSTEM_DATABASES | {db_name}
 
     with src.cur() as cur:
-        cur.execute(
-            "SELECT TABLE_SCHEMA FROM INFORMATION_SCHEMA.TABLES "
-            "WHERE TABLE_SCHEMA NOT IN ({format_dbs})".format(format_dbs=", ".join(["%s"] * len(ignore_dbs))),
-            tuple(ignore_dbs)
-        )
+        cur.execute("SELECT TABLE_SCHEMA FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA NOT IN %s", (tuple(ignore_dbs), ))
         other_test_dbs = {table_schema["TABLE_SCHEMA"] for table_schema in cur.fetchall()}
 
-    with src.cur() as cur:
         cur.execute(f"CREATE DATABASE {db_name}")
         cur.execute(f"USE {db_name}")
         cur.execute("CREATE TABLE test (ID TEXT)")
         cur.execute("INSERT INTO test (ID) VALUES (%s)", ["test_data"])
 
-    migration = MySQLMigration(
-        source_uri=src.to_uri(),
-        target_uri=dst.to_uri(),
-        target_master_uri=dst.to_uri(),
-    )
+    migration = make_migration(src, dst)
 
     # Should fit to this size.
     migration.run_checks(dbs_max_total_size=1048576)
@@ -202,32 +236,20 @@ def test_database_size_check(src, dst, db_name):
     migration.run_checks(dbs_max_total_size=0)
 
 
-@mark.parametrize("src,dst", [
-    (my_wait("mysql80-src-4", ssl=False), my_wait("mysql80-dst-3")),
-])
-def test_database_ssl_disabled(src, dst, db_name):
-    ignore_dbs = IGNORE_SYSTEM_DATABASES.copy()
-    ignore_dbs.add(db_name)
-
+@mark.parametrize("mysql_pair", [pair_param("80-nossl-80-3")], indirect=True)
+def test_database_ssl_disabled(mysql_pair, db_name):
+    src, dst = mysql_pair
     with src.cur() as cur:
         cur.execute(f"CREATE DATABASE {db_name}")
         cur.execute(f"USE {db_name}")
         cur.execute("CREATE TABLE test (ID TEXT)")
 
     # Default check without SSL should pass
-    migration = MySQLMigration(
-        source_uri=src.to_uri(),
-        target_uri=dst.to_uri(),
-        target_master_uri=dst.to_uri(),
-    )
+    migration = make_migration(src, dst)
     migration.run_checks()
 
     # Enable SSL and now it should fail
-    src.ssl = True
-    migration = MySQLMigration(
-        source_uri=src.to_uri(),
-        target_uri=dst.to_uri(),
-        target_master_uri=dst.to_uri(),
-    )
+    src = dataclasses.replace(src, ssl=True)
+    migration = make_migration(src, dst)
     with pytest.raises(SSLNotSupportedException):
         migration.run_checks()